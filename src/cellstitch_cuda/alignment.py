@@ -8,13 +8,20 @@ import time
 
 
 class FramePair:
-    def __init__(self, mask0, mask1, max_lbl=0):
-        self.frame0 = Frame(mask0)
-        self.frame1 = Frame(mask1)
+    def __init__(self, mask0, mask1, max_lbl=0, lbls0=None, lbls1=None):
+        """A pair of frames to stitch.
 
-        # store the max labels for stitching
-        max_lbl_default = max(
-            self.frame0.get_lbls().max(), self.frame1.get_lbls().max()
+        New labels are numbered from the highest of max_lbl and the labels of both frames, so a caller that tracks the
+        highest label of the whole volume passes it as max_lbl. lbls0 and lbls1 optionally hold the sorted unique labels
+        of mask0 and mask1, if they are already known.
+        """
+        self.frame0 = Frame(mask0, lbls0)
+        self.frame1 = Frame(mask1, lbls1)
+
+        # store the max labels for stitching. The labels are sorted and cached for stitch(), so their maxima are simply
+        # their last elements
+        max_lbl_default = int(
+            cp.maximum(self.frame0.get_lbls()[-1], self.frame1.get_lbls()[-1])
         )
 
         self.max_lbl = max(max_lbl, max_lbl_default)
@@ -38,41 +45,45 @@ class FramePair:
         plt.tight_layout()
         plt.show()
 
-    def get_plan(self, C):
-        """
-        Compute the transport plan between the two frames, given the cost matrix between the cells.
+    def get_plan(
+        self, C, sizes0, sizes1, reg=1e-2, max_emd_size=2**16, num_iter_max=1000, stop_thr=1e-4
+    ):
         """
-        mask0 = cp.asarray(self.frame0.mask)
-        mask1 = cp.asarray(self.frame1.mask)
+        Compute the transport plan between the two frames, given the cost matrix and the sizes of the cells.
 
-        unique_labels0, counts0 = cp.unique(mask0, return_counts=True)
-        unique_labels1, counts1 = cp.unique(mask1, return_counts=True)
-        sizes0 = cp.asarray(counts0)
-        sizes1 = cp.asarray(counts1)
+        Small problems (at most max_emd_size entries in C, or any size if max_emd_size is None) are solved exactly with
+        ot.emd, which runs on the CPU. Larger ones are solved on the GPU with log-domain Sinkhorn, using entropic
+        regularization reg, for at most num_iter_max iterations or until the marginals are within stop_thr.
+        """
 
         # convert to distribution to compute transport plan
         dist0 = sizes0 / cp.sum(sizes0)
         dist1 = sizes1 / cp.sum(sizes1)
 
         # compute transportation plan
-        plan = ot.emd(dist0, dist1, C)
+        if max_emd_size is None or C.size <= max_emd_size:
+            plan = ot.emd(dist0, dist1, C)
+        else:
+            plan = ot.sinkhorn(
+                dist0,
+                dist1,
+                C,
+                reg,
+                method="sinkhorn_log",
+                numItermax=num_iter_max,
+                stopThr=stop_thr,
+            )
 
-        return plan, mask1
+        return plan
 
-    def get_cost_matrix(self, overlap, lbls0, lbls1):
+    def get_cost_matrix(self, overlap, lbls0, lbls1, sizes0, sizes1):
         """
         Return the cost matrix between cells in the two frame defined by IoU.
         """
 
-        sizes0 = cp.sum(overlap, axis=1)
-        sizes1 = cp.sum(overlap, axis=0)
-
-        # Create a meshgrid for vectorized operations
-        lbl0_indices, lbl1_indices = cp.meshgrid(lbls0, lbls1, indexing="ij")
-
-        overlap_sizes = overlap[lbl0_indices, lbl1_indices]
+        overlap_sizes = _overlap_matrix(overlap, lbls0, lbls1)
         scaling_factors = overlap_sizes / (
-            sizes0[lbl0_indices] + sizes1[lbl1_indices] - overlap_sizes
+            sizes0[:, None] + sizes1[None, :] - overlap_sizes
         )
 
         C = 1 - scaling_factors
@@ -80,73 +91,101 @@ class FramePair:
         return C
 
     def stitch(
-        self, yz_not_stitched, xz_not_stitched, p_stitching_votes=0.75, verbose=False
+        self,
+        yz_not_stitched,
+        xz_not_stitched,
+        p_stitching_votes=0.75,
+        verbose=False,
+        reg=1e-2,
+        max_emd_size=2**16,
+        num_iter_max=1000,
     ):
-        """Stitch frame1 using frame 0."""
+        """Stitch frame1 using frame 0.
+
+        reg, max_emd_size and num_iter_max are passed to get_plan; set max_emd_size to None to always use exact ot.emd.
+        """
 
         time_start = time.time()
 
         lbls0 = self.frame0.get_lbls()  # Get unique label IDs
         lbls1 = self.frame1.get_lbls()  # Get unique label IDs
 
+        mask0 = cp.asarray(self.frame0.mask)
+        mask1 = cp.asarray(self.frame1.mask)
+
         # get sizes
-        overlap = _label_overlap_cupy(self.frame0.mask, self.frame1.mask)
+        overlap = _label_overlap_cupy(mask0, mask1, max_lbl=self.max_lbl)
+        cell_sizes = cp.bincount(mask1.ravel())
+        sizes0 = cp.bincount(mask0.ravel())[lbls0]
+        sizes1 = cell_sizes[lbls1]
 
         # compute matching
-        C = self.get_cost_matrix(overlap, lbls0, lbls1)
-        plan, mask1 = self.get_plan(C)
+        C = self.get_cost_matrix(overlap, lbls0, lbls1, sizes0, sizes1)
+        plan = self.get_plan(
+            C,
+            sizes0,
+            sizes1,
+            reg=reg,
+            max_emd_size=max_emd_size,
+            num_iter_max=num_iter_max,
+        )
 
-        # get a soft matching from plan
+        # get a soft matching from plan: every cell0 is matched to the cell1 it sends most of its mass to
         n, m = plan.shape
-        soft_matching = cp.zeros((n, m))
-
-        # Vectorized computation
         matched_indices = plan.argmax(axis=1)
-        soft_matching[cp.arange(n), matched_indices] = 1
-
-        stitched_mask1 = cp.zeros(mask1.shape)
-        for lbl1_index in range(1, m):
-            # find the cell with the lowest cost (i.e. lowest scaled distance)
-            matching_filter = soft_matching[:, lbl1_index]
-            filtered_C = cp.where(
-                matching_filter == 0, cp.Inf, C[:, lbl1_index]
-            )  # ignore the non-matched cells
+        matched_costs = C[cp.arange(n), matched_indices]
+
+        # find the matched cell0 with the lowest cost (i.e. lowest scaled distance) for every cell1
+        lowest_costs = cp.full(m, cp.inf)
+        cupyx.scatter_min(lowest_costs, matched_indices, matched_costs)
+        is_lowest = matched_costs == lowest_costs[matched_indices]
+
+        lbl0_indices = cp.full(m, n, dtype=cp.int32)
+        cupyx.scatter_min(
+            lbl0_indices,
+            matched_indices[is_lowest],
+            cp.arange(n, dtype=cp.int32)[is_lowest],
+        )
+        lbl0_indices[lbl0_indices == n] = 0  # cells1 that no cell0 is matched to
 
-            lbl0_index = cp.argmin(
-                filtered_C
-            )  # this is the cell0 we will attempt to relabel cell1 with
+        # these are the cells0 we will attempt to relabel cells1 with
+        lbls0_matched = lbls0[lbl0_indices]
 
-            lbl0, lbl1 = int(lbls0[lbl0_index]), int(lbls1[lbl1_index])
+        # count the pixels of each cell1 that the orthogonal planes vote against stitching, summing both votes first
+        # so mask1 is only binned once
+        votes = yz_not_stitched.astype(cp.uint8) + xz_not_stitched
+        n_not_stitch_pixel = cp.bincount(mask1.ravel(), weights=votes.ravel())[lbls1] / 2
+        stitch_cell = n_not_stitch_pixel <= (1 - p_stitching_votes) * sizes1
 
-            n_not_stitch_pixel = (
-                yz_not_stitched[mask1 == lbl1].sum() / 2
-                + xz_not_stitched[mask1 == lbl1].sum() / 2
-            )
-            stitch_cell = (
-                n_not_stitch_pixel <= (1 - p_stitching_votes) * (mask1 == lbl1).sum()
-            )
+        # only reassign if they overlap, otherwise create a new label
+        new_cell = (lbls0_matched == 0) | ~stitch_cell
+        new_cell[0] = False
+        lut_lbls = cp.where(new_cell, self.max_lbl + cp.cumsum(new_cell), lbls0_matched)
+        lut_lbls[0] = 0
+        self.max_lbl += int(new_cell.sum())
 
-            if lbl0 != 0 and stitch_cell:  # only reassign if they overlap
-                stitched_mask1[mask1 == lbl1] = lbl0
-            else:
-                self.max_lbl += 1
-                stitched_mask1[mask1 == lbl1] = self.max_lbl  # create a new label
+        lut = cp.zeros(cell_sizes.size, dtype=lut_lbls.dtype)
+        lut[lbls1] = lut_lbls
+        stitched_mask1 = lut[mask1]
 
         if verbose:
             print("Time to stitch: ", time.time() - time_start)
 
-        self.frame1 = Frame(stitched_mask1)
+        self.frame1 = Frame(stitched_mask1, cp.unique(lut_lbls))
 
 
-def _label_overlap_cupy(x, y):
+def _label_overlap_cupy(x, y, max_lbl=None):
     """Fast function to get pixel overlaps between masks in x and y.
 
         Args:
             x (np.ndarray, int): Where 0=NO masks; 1,2... are mask labels.
             y (np.ndarray, int): Where 0=NO masks; 1,2... are mask labels.
+            Labels in both x and y must fit in 32 bits.
+            max_lbl (int, optional): Upper bound on the labels in x and y, if already known on the host.
 
         Returns:
-            overlap (np.ndarray, int): Matrix of pixel overlaps of size [x.max()+1, y.max()+1].
+            overlap (tuple of cp.ndarray): Sparse (COO) overlap matrix as (rows, cols, counts), where counts[i] is the
+                number of pixels with label rows[i] in x and label cols[i] in y. Only overlapping pairs are listed.
 
         Adapted from CellPose: https://github.com/MouseLand/cellpose
             https://doi.org/10.1038/s41592-020-01018-x: Stringer, C., Wang, T., Michaelos, M., & Pachitariu, M. (2021).
@@ -154,14 +193,40 @@ def _label_overlap_cupy(x, y):
             Copyright © 2023 Howard Hughes Medical Institute, Authored by Carsen Stringer and Marius Pachitariu.
         """
     # put label arrays into standard form then flatten them
-    x = cp.asarray(x.ravel())
-    y = cp.asarray(y.ravel())
-    xmax = int(x.max())
-    ymax = int(y.max())
+    x = cp.asarray(x).ravel()
+    y = cp.asarray(y).ravel()
+
+    # encode every (x, y) label pair as a single key, and count the pairs that actually occur by sorting the keys. A
+    # fixed shift avoids having to pull y.max() to the host first; 16-bit labels fit a 32-bit key, which halves the
+    # traffic of the sort.
+    if max_lbl is not None and max_lbl < 2**16 or max(x.itemsize, y.itemsize) <= 2:
+        key_dtype, shift = cp.uint32, 16
+    else:
+        key_dtype, shift = cp.uint64, 32
+    key = (x.astype(key_dtype) << shift) | y.astype(key_dtype)
+    key, counts = cp.unique(key, return_counts=True)
+
+    return key >> shift, key & ((1 << shift) - 1), counts.astype(cp.uint32)
+
+
+def _overlap_matrix(overlap, lbls0, lbls1):
+    """Densify a sparse overlap from _label_overlap_cupy into a matrix of size [len(lbls0), len(lbls1)].
+
+    Args:
+        overlap (tuple of cp.ndarray): Sparse overlap as (rows, cols, counts).
+        lbls0 (cp.ndarray, int): Sorted row labels to keep.
+        lbls1 (cp.ndarray, int): Sorted column labels to keep.
+
+    Returns:
+        matrix (cp.ndarray, int): Pixel overlaps between lbls0[i] and lbls1[j].
+    """
+    rows, cols, counts = overlap
 
-    # preallocate a "contact map" matrix
-    overlap = cp.zeros((1 + xmax, 1 + ymax), dtype=cp.uint)
+    i = cp.minimum(cp.searchsorted(lbls0, rows), lbls0.size - 1)
+    j = cp.minimum(cp.searchsorted(lbls1, cols), lbls1.size - 1)
+    keep = (lbls0[i] == rows) & (lbls1[j] == cols)
 
-    cupyx.scatter_add(overlap, (x, y), 1)
+    matrix = cp.zeros((lbls0.size, lbls1.size), dtype=counts.dtype)
+    matrix[i[keep], j[keep]] = counts[keep]
 
-    return overlap
+    return matrix
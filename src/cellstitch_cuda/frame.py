@@ -2,12 +2,18 @@ import cupy as cp
 
 
 class Frame:
-    def __init__(self, mask):
-        """A container to the mask with useful features."""
+    def __init__(self, mask, lbls=None):
+        """A container to the mask with useful features.
+
+        lbls optionally holds the sorted unique labels of mask, if they are already known.
+        """
         self.mask = mask
+        self.lbls = lbls
 
     def get_lbls(self):
-        return cp.unique(self.mask)
+        if self.lbls is None:
+            self.lbls = cp.unique(self.mask)
+        return self.lbls
 
     def is_empty(self):
         """
@@ -20,9 +26,8 @@ class Frame:
         returns the centroids of each cell in the frame.
         """
         lbls = self.get_lbls()[1:]
-        locations = []
-        # compute the average
-        for lbl in lbls:
-            coords = cp.asarray((self.mask == lbl)).T  # mask to coord
-            locations.append(cp.average(coords, axis=0))
-        return cp.array(locations)
+        mask = cp.asarray(self.mask).ravel()
+        # compute the average of the pixel coordinates of all cells at once, with one bincount per axis
+        coords = cp.indices(self.mask.shape).reshape(self.mask.ndim, -1)
+        sums = cp.stack([cp.bincount(mask, weights=c) for c in coords], axis=1)
+        return sums[lbls] / cp.bincount(mask)[lbls, None]
@@ -1,5 +1,8 @@
 import tifffile
 import os
+import re
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
 from cellstitch_cuda.alignment import _label_overlap_cupy
 from instanseg import InstanSeg
@@ -10,41 +13,61 @@ from cellstitch_cuda.alignment import *
 from cellstitch_cuda.preprocessing_cupy import *
 
 
-def relabel_layer(masks, z, lbls):
-    """
-    Relabel the label in LBLS in layer Z of MASKS.
-    """
-    layer = masks[z]
-    if z != 0:
-        reference_layer = masks[z - 1]
-    else:
-        reference_layer = masks[z + 1]
+# A key=value pair in ImageJ metadata
+_METADATA_ITEM = re.compile(r"(\w+)\s*=\s*(\S+)")
 
-    overlap = _label_overlap_cupy(reference_layer, layer)
-
-    for lbl in lbls:
-        lbl0 = cp.argmax(overlap[:, lbl])
-        layer[layer == lbl] = lbl0
+# Pixels that are labeled in both frames, but with different labels
+_not_stitched = cp.ElementwiseKernel(
+    "T a, T b",
+    "bool out",
+    "out = (a != 0) && (b != 0) && (a != b)",
+    "not_stitched",
+)
 
 
 def overseg_correction(masks):
     masks_cp = cp.asarray(masks)
-    lbls = cp.unique(masks_cp)[1:]
-
-    # get a list of labels that need to be corrected
-    layers_lbls = {}
+    max_lbl = int(masks_cp.max())
+
+    # find the first and last layer each label exists in
+    first_z = cp.full(max_lbl + 1, masks_cp.shape[0], dtype=cp.int32)
+    last_z = cp.full(max_lbl + 1, -1, dtype=cp.int32)
+    for z in range(masks_cp.shape[0]):
+        cupyx.scatter_min(first_z, masks_cp[z].ravel(), z)
+        cupyx.scatter_max(last_z, masks_cp[z].ravel(), z)
+    first_z[0] = masks_cp.shape[0]  # never correct the background
+
+    # get the labels that need to be corrected, i.e. the ones that exist in a single layer
+    is_single = first_z == last_z
+
+    # scatter_min only supports 32 and 64 bit unsigned integers, so the table is built unsigned
+    lut = cp.arange(
+        max_lbl + 1, dtype=cp.uint64 if masks_cp.dtype.itemsize == 8 else cp.uint32
+    )
+
+    # relabel layer by layer from the top, each against its reference layer as corrected so far, so that a chain of
+    # single-layer labels ends up as one label
+    for z in cp.unique(first_z[is_single]).get().tolist():
+        layer = masks_cp[z]
+        if z != 0:
+            reference_layer = masks_cp[z - 1]
+        else:
+            reference_layer = masks_cp[min(1, masks_cp.shape[0] - 1)]
 
-    for lbl in lbls:
-        existing_layers = cp.any(masks_cp == lbl, axis=(1, 2))
-        depth = cp.sum(existing_layers)
+        # only count the pixels of the labels to correct, each paired with the same pixel of the reference layer
+        pixels = is_single[layer]
+        reference_lbls, lbls, counts = _label_overlap_cupy(
+            reference_layer[pixels], layer[pixels], max_lbl=max_lbl
+        )
 
-        if depth == 1:
-            z = int(cp.where(existing_layers)[0][0])
-            layers_lbls.setdefault(z, []).append(lbl)
+        # relabel every such label with the reference label it overlaps most, preferring the lowest label on ties
+        max_counts = cp.zeros(max_lbl + 1, dtype=counts.dtype)
+        cupyx.scatter_max(max_counts, lbls, counts)
+        is_max = counts == max_counts[lbls]
 
-    for z, lbls in layers_lbls.items():
-        relabel_layer(masks_cp, z, lbls)
-        cp._default_memory_pool.free_all_blocks()
+        lut[lbls] = cp.iinfo(lut.dtype).max
+        cupyx.scatter_min(lut, lbls[is_max], reference_lbls[is_max].astype(lut.dtype))
+        masks_cp[z] = lut[layer]
 
     masks = masks_cp.get()
     cp._default_memory_pool.free_all_blocks()
@@ -52,35 +75,68 @@ def overseg_correction(masks):
     return masks
 
 
-def full_stitch(xy_masks_prior, yz_masks, xz_masks, nuclei=None, filter: bool = True, n_jobs=-1, verbose=False):
-    """Stitch masks in-place
+def full_stitch(
+    xy_masks_prior,
+    yz_masks,
+    xz_masks,
+    nuclei=None,
+    filter: bool = True,
+    n_jobs=-1,
+    verbose=False,
+    reg=1e-2,
+    max_emd_size=2**16,
+    num_iter_max=1000,
+):
+    """Stitch masks
 
-    Stitches masks from top to bottom.
+    Stitches masks from top to bottom, on a copy of the XY masks on the GPU. If xy_masks_prior is already a uint32
+    cupy.ndarray, it is relabeled in place rather than copied; pass a copy to keep the original masks.
 
     Args:
-        xy_masks_prior: numpy.ndarray with XY masks
-        yz_masks: numpy.ndarray with YZ masks
-        xz_masks: numpy.ndarray with XZ masks
+        xy_masks_prior: numpy.ndarray or cupy.ndarray with XY masks
+        yz_masks: numpy.ndarray or cupy.ndarray with YZ masks
+        xz_masks: numpy.ndarray or cupy.ndarray with XZ masks
         nuclei: numpy.ndarray with XY masks of nuclei
         filter: Use CellPose-based fill_holes_and_remove_small_masks() function. Default True
-        n_jobs: Number of threads used. Set n_jobs to 1 for debugging parallel processing tasks. Default -1
+        n_jobs: Unused, since holes are now filled on the GPU. Kept for backwards compatibility. Default -1
         verbose: Verbosity. Default False
+        reg: Entropic regularization of the Sinkhorn solver used for large frame pairs. Default 1e-2
+        max_emd_size: Largest cost matrix (in entries) that is matched exactly with ot.emd; larger ones use Sinkhorn.
+            Set to None to always use ot.emd. Default 2**16
+        num_iter_max: Maximum number of Sinkhorn iterations. Default 1000
     """
 
-    xy_masks = np.array(xy_masks_prior, dtype="uint32")
+    # upload in the original dtype and widen on the device, which avoids a uint32 copy of the volume on the host
+    xy_masks = cp.asarray(xy_masks_prior).astype(cp.uint32, copy=False)
     num_frame = xy_masks.shape[0]
     prev_index = 0
 
-    while Frame(xy_masks[prev_index]).is_empty():
+    # upload the orthogonal masks once, rather than two planes of each for every frame pair
+    yz_masks = cp.asarray(yz_masks)
+    xz_masks = cp.asarray(xz_masks)
+
+    # find the empty slices, i.e. the ones holding a single label (usually just background), which are not stitched
+    nonempty = (xy_masks.max(axis=(1, 2)) != xy_masks.min(axis=(1, 2))).get()
+
+    while not nonempty[prev_index]:
         prev_index += 1
 
     curr_index = prev_index + 1
 
+    # the highest label is kept up to date from the frame pairs, rather than re-reduced every frame
+    max_lbl = int(xy_masks.max())
+
+    # labels of the previous frame, carried over from its stitching
+    prev_lbls = None
+
+    # the vote maps of every frame pair are written into the same two buffers
+    yz_not_stitched = cp.empty(xy_masks.shape[1:], dtype=bool)
+    xz_not_stitched = cp.empty(xy_masks.shape[1:], dtype=bool)
+
     time_start = time.time()
 
     while curr_index < num_frame:
-        cp._default_memory_pool.free_all_blocks()
-        if Frame(xy_masks[curr_index]).is_empty():
+        if not nonempty[curr_index]:
             # if frame is empty, skip
             curr_index += 1
         else:
@@ -90,22 +146,30 @@ def full_stitch(xy_masks_prior, yz_masks, xz_masks, nuclei=None, filter: bool =
                     % (curr_index, prev_index)
                 )
 
-            yz_not_stitched = cp.asarray(
-                (yz_masks[prev_index] != 0)
-                * (yz_masks[curr_index] != 0)
-                * (yz_masks[prev_index] != yz_masks[curr_index])
+            yz_not_stitched = _not_stitched(
+                yz_masks[prev_index], yz_masks[curr_index], yz_not_stitched
             )
-            xz_not_stitched = cp.asarray(
-                (xz_masks[prev_index] != 0)
-                * (xz_masks[curr_index] != 0)
-                * (xz_masks[prev_index] != xz_masks[curr_index])
+            xz_not_stitched = _not_stitched(
+                xz_masks[prev_index], xz_masks[curr_index], xz_not_stitched
             )
 
             fp = FramePair(
-                xy_masks[prev_index], xy_masks[curr_index], max_lbl=xy_masks.max()
+                xy_masks[prev_index],
+                xy_masks[curr_index],
+                max_lbl=max_lbl,
+                lbls0=prev_lbls,
             )
-            fp.stitch(yz_not_stitched, xz_not_stitched, verbose=verbose)
-            xy_masks[curr_index] = fp.frame1.mask.get()
+            fp.stitch(
+                yz_not_stitched,
+                xz_not_stitched,
+                verbose=verbose,
+                reg=reg,
+                max_emd_size=max_emd_size,
+                num_iter_max=num_iter_max,
+            )
+            max_lbl = fp.max_lbl
+            xy_masks[curr_index] = fp.frame1.mask
+            prev_lbls = fp.frame1.get_lbls()
 
             prev_index = curr_index
             curr_index += 1
@@ -114,7 +178,6 @@ def full_stitch(xy_masks_prior, yz_masks, xz_masks, nuclei=None, filter: bool =
         print("Total time to stitch: ", time.time() - time_start)
 
     if filter:
-        cp._default_memory_pool.free_all_blocks()
         time_start = time.time()
         xy_masks = fill_holes_and_remove_small_masks(xy_masks, n_jobs=n_jobs)
         if verbose:
@@ -143,6 +206,27 @@ def full_stitch(xy_masks_prior, yz_masks, xz_masks, nuclei=None, filter: bool =
     return xy_masks
 
 
+@functools.lru_cache(maxsize=2)
+def _get_model(name):
+    """Load the InstanSeg model NAME once, and reuse it in later calls."""
+    return InstanSeg(name)
+
+
+def _finish_writes(writer, writes):
+    """Wait for the masks that WRITER is writing in the background, re-raising any error from WRITES."""
+    writer.shutdown(wait=True)
+    for write in writes:
+        write.result()
+
+
+def _parse_metadata(text):
+    """Parse the key=value pairs of an ImageJ image description or Info block into a dict.
+
+    The first occurrence of a key wins.
+    """
+    return dict(reversed(_METADATA_ITEM.findall(text)))
+
+
 def cellstitch_cuda(
     img,
     output_masks: bool = False,
@@ -155,6 +239,7 @@ def cellstitch_cuda(
     filtering: bool = True,
     n_jobs: int = -1,
     verbose: bool = False,
+    max_emd_size=2**16,
 ):
     """All-in-one function to segment and stitch 2D labels
 
@@ -185,11 +270,13 @@ def cellstitch_cuda(
         filtering: Whether the fill_holes_and_remove_small_masks function should be executed. With larger datasets, this
             has the tendency to massively slow down the postprocessing.
             Default True
-        n_jobs: Set the number of threads to be used in parallel processing tasks. Use 1 for debugging. Generally, best
-            left at the default value.
+        n_jobs: Unused, since holes are now filled on the GPU. Kept for backwards compatibility.
             Default -1
         verbose: Verbosity.
             Default False
+        max_emd_size: Largest cost matrix (in entries) that CellStitch matches exactly with ot.emd; larger ones use the
+            faster, approximate Sinkhorn solver on the GPU. Set to None to always use ot.emd.
+            Default 2**16
     """
 
     # Check cuda
@@ -198,14 +285,24 @@ def cellstitch_cuda(
     else:
         print("CUDA is not available; using CPU.")
 
-    # Initialize path
+    # Initialize path and metadata
     path = ""
+    tags = {}
+
+    # Intermediate masks are written in the background, so the GPU does not wait on the disk
+    writer = ThreadPoolExecutor(max_workers=2)
+    writes = []
 
     # Read image file
     if os.path.isfile(img):
         path = str(img)
         with tifffile.TiffFile(path) as tif:
-            img = tif.asarray()  # ZCYX
+            if bleach_correct:
+                img = tif.asarray()  # ZCYX
+            else:
+                # uploaded as a whole below, so read straight into pinned memory, which uploads faster than pageable
+                img = cupyx.empty_pinned(tif.series[0].shape, dtype=tif.series[0].dtype)
+                img = tif.asarray(out=img)  # ZCYX
             tags = tif.pages[0].tags
     elif not isinstance(img, np.ndarray):
         print("img must either be a path to an existing image, or a numpy ndarray.")
@@ -222,30 +319,24 @@ def cellstitch_cuda(
             pixel_size = 1 / (tags["XResolution"].value[0] / tags["XResolution"].value[1])
             if verbose:
                 print("Pixel size:", pixel_size)
-        except:
+        except (KeyError, IndexError, TypeError, ZeroDivisionError):
             print(
                 "No XResolution found in image metadata. The output might not be fully reliable."
             )
     if z_step is None:
+        metadata = {}
+        if "ImageDescription" in tags:
+            metadata = _parse_metadata(tags["ImageDescription"].value)
+        if "spacing" not in metadata and "IJMetadata" in tags:
+            metadata = _parse_metadata(tags["IJMetadata"].value.get("Info", ""))
         try:
-            img_descr = tags["ImageDescription"].value.split()
-            z_step = float(
-                [s for s in img_descr if "spacing" in s][0].split("=")[-1]
-            )  # At least it's pretty fast
+            z_step = float(metadata["spacing"])
             if verbose:
                 print("Z step:", z_step)
-        except:
-            try:
-                img_descr = tags["IJMetadata"].value["Info"].split()
-                z_step = float(
-                    [s for s in img_descr if "spacing" in s][0].split("=")[-1]
-                )  # It's even funnier the second time
-                if verbose:
-                    print("Z step:", z_step)
-            except:
-                print(
-                    "No spacing (Z step) found in image metadata. The output might not be fully reliable."
-                )
+        except (KeyError, ValueError):
+            print(
+                "No spacing (Z step) found in image metadata. The output might not be fully reliable."
+            )
 
     # Set up output path
     if output_masks:
@@ -255,16 +346,23 @@ def cellstitch_cuda(
             os.makedirs(output_path)
 
     # Instanseg-based pipeline
-    model = InstanSeg("fluorescence_nuclei_and_cells")
+    model = _get_model("fluorescence_nuclei_and_cells")
 
     # Correct bleaching over Z-axis
     if bleach_correct:
         img = histogram_correct(img)
-        cp._default_memory_pool.free_all_blocks()
         if verbose:
             print("Finished bleach correction.")
 
-    img = img.transpose(1, 2, 3, 0)  # ZCYX -> CYXZ
+    img = cp.ascontiguousarray(
+        cp.asarray(img).transpose(1, 2, 3, 0)
+    )  # ZCYX -> CYXZ, transposed on the GPU like the YZ and XZ views below
+
+    # Release the pinned host copy of the image, rather than keeping it page-locked in CuPy's pinned memory pool, and
+    # the freed ZCYX device copy, which InstanSeg would otherwise not count as available VRAM
+    cp.cuda.get_current_stream().synchronize()
+    cp.get_default_pinned_memory_pool().free_all_blocks()
+    cp._default_memory_pool.free_all_blocks()
 
     # Segment over Z-axis
     if verbose:
@@ -280,7 +378,13 @@ def cellstitch_cuda(
         )  # YXZ -> ZYX
 
         if output_masks:
-            tifffile.imwrite(os.path.join(output_path, "nuclei_masks.tif"), nuclei)
+            writes.append(
+                writer.submit(
+                    tifffile.imwrite,
+                    os.path.join(output_path, "nuclei_masks.tif"),
+                    nuclei,
+                )
+            )
     else:
         yx_masks = yx_masks.transpose(
             2, 0, 1
@@ -290,7 +394,11 @@ def cellstitch_cuda(
         torch.cuda.empty_cache()  # Clear GPU cache
 
     if output_masks:
-        tifffile.imwrite(os.path.join(output_path, "yx_masks.tif"), yx_masks)
+        writes.append(
+            writer.submit(
+                tifffile.imwrite, os.path.join(output_path, "yx_masks.tif"), yx_masks
+            )
+        )
 
     if stitch_method == "iou":
 
@@ -302,13 +410,16 @@ def cellstitch_cuda(
         if verbose:
             print("Running IoU stitching...")
 
-        iou_masks = stitch3D(yx_masks, stitch_threshold=0.25)
+        iou_masks = stitch3D(
+            yx_masks.astype(np.uint32), stitch_threshold=0.25
+        )  # Stitching creates new labels across Z
 
         if seg_mode == "nuclei_cells":
             iou_masks = filter_nuclei_cells(iou_masks, nuclei)
 
         if output_masks:
             tifffile.imwrite(os.path.join(output_path, "iou_masks.tif"), iou_masks)
+        _finish_writes(writer, writes)
 
         return iou_masks
 
@@ -321,7 +432,9 @@ def cellstitch_cuda(
         transposed_img = upscale_img(
             transposed_img, pixel_size, z_step
         )  # Preprocess YZ planes
-        cp._default_memory_pool.free_all_blocks()
+        xz_upscaled = upscale_img_async(
+            img.transpose(0, 2, 3, 1), pixel_size, z_step
+        )  # Preprocess XZ planes (CYXZ -> CXZY) while the YZ planes are segmented
         yz_masks = segmentation(transposed_img, model, seg_mode)
         del transposed_img
         if torch.cuda.is_available():
@@ -331,17 +444,20 @@ def cellstitch_cuda(
         ).transpose(
             1, 0, 2
         )  # YZX -> ZYX
-        cp._default_memory_pool.free_all_blocks()
         if output_masks:
-            tifffile.imwrite(os.path.join(output_path, "yz_masks.tif"), yz_masks)
+            writes.append(
+                writer.submit(
+                    tifffile.imwrite,
+                    os.path.join(output_path, "yz_masks.tif"),
+                    yz_masks.get(),
+                )
+            )
 
         # Segment over Y-axis
         if verbose:
             print("Segmenting XZ planes (Y-axis).")
-        transposed_img = img.transpose(0, 2, 3, 1)  # CYXZ -> CXZY
-        transposed_img = upscale_img(
-            transposed_img, pixel_size, z_step
-        )  # Preprocess XZ planes
+        transposed_img = xz_upscaled.result()
+        del img  # Free the device image before InstanSeg estimates the available VRAM
         cp._default_memory_pool.free_all_blocks()
         xz_masks = segmentation(transposed_img, model, seg_mode)
         if torch.cuda.is_available():
@@ -351,12 +467,17 @@ def cellstitch_cuda(
         ).transpose(
             1, 2, 0
         )  # XZY -> ZYX
-        cp._default_memory_pool.free_all_blocks()
         if output_masks:
-            tifffile.imwrite(os.path.join(output_path, "xz_masks.tif"), xz_masks)
+            writes.append(
+                writer.submit(
+                    tifffile.imwrite,
+                    os.path.join(output_path, "xz_masks.tif"),
+                    xz_masks.get(),
+                )
+            )
 
         # Memory cleanup
-        del model, img, transposed_img
+        del model, transposed_img
         if torch.cuda.is_available():
             torch.cuda.empty_cache()  # Clear GPU cache
 
@@ -365,17 +486,30 @@ def cellstitch_cuda(
 
         if seg_mode == "nuclei_cells":
             cellstitch_masks = full_stitch(
-                yx_masks, yz_masks, xz_masks, nuclei, filter=filtering, verbose=verbose
+                yx_masks,
+                yz_masks,
+                xz_masks,
+                nuclei,
+                filter=filtering,
+                verbose=verbose,
+                max_emd_size=max_emd_size,
             )
         else:
             cellstitch_masks = full_stitch(
-                yx_masks, yz_masks, xz_masks, filter=filtering, n_jobs=n_jobs, verbose=verbose
+                yx_masks,
+                yz_masks,
+                xz_masks,
+                filter=filtering,
+                n_jobs=n_jobs,
+                verbose=verbose,
+                max_emd_size=max_emd_size,
             )
 
         if output_masks:
             tifffile.imwrite(
                 os.path.join(output_path, "cellstitch_masks.tif"), cellstitch_masks
             )
+        _finish_writes(writer, writes)
 
         return cellstitch_masks
 
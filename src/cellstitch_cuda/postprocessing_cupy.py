@@ -1,24 +1,114 @@
 import cupy as cp
+import cupyx
 import numpy as np
-from scipy.ndimage import find_objects, binary_fill_holes
-from joblib import Parallel, delayed
+from scipy.ndimage import find_objects, generate_binary_structure
+from cupyx.scipy.ndimage import label
 
 
-def process_slice(i, slc, masks):
-    if slc is not None:
-        msk = masks[slc] == (i + 1)
-        if msk.ndim == 3:
-            msk = np.array([binary_fill_holes(msk[k]) for k in range(msk.shape[0])])
-        else:
-            msk = binary_fill_holes(msk)
-        return slc, msk
-    return None
+# Upper bound on the pixels in a stack of bounding boxes that is filled at once
+_FILL_BATCH_PIXELS = 2**26
+
+# Flag every label that overlaps a nucleus
+_flag_nuclear = cp.ElementwiseKernel(
+    "T label, N nucleus",
+    "raw bool flags",
+    "if (nucleus != 0) flags[label] = true;",
+    "flag_nuclear",
+)
+
+
+def _fill_holes(masks, slices):
+    """Fill the holes in every mask plane by plane on the GPU.
+
+    The bounding box planes of all masks are stacked (in batches of at most _FILL_BATCH_PIXELS pixels) and filled
+    together: the pixels outside each mask are labelled in a single connected components pass, with a structuring
+    element that does not connect neighbouring planes, and the components that do not reach the edge of their plane
+    are holes. Every filled pixel is then given the highest label whose filled mask covers it.
+
+    Args:
+        masks (cp.ndarray, int): 2D or 3D array of labelled masks.
+        slices (list): Bounding boxes of the masks, as returned by find_objects(masks).
+
+    Returns:
+        filled (cp.ndarray, int): The masks with their holes filled, in the dtype of masks.
+    """
+    masks_cp = cp.asarray(masks)
+    # scatter_max only supports 32 and 64 bit unsigned integers, so labels are written into an unsigned working copy
+    filled = masks_cp.astype(cp.uint64 if masks_cp.dtype.itemsize == 8 else cp.uint32)
+    planes = masks_cp.reshape((-1,) + masks_cp.shape[-2:])  # 2D masks are one plane
+
+    structure = cp.zeros((3, 3, 3), dtype=bool)
+    structure[1] = cp.asarray(generate_binary_structure(2, 1))
+
+    # bounding boxes as rows of (label, z, y, x, depth, height, width), smallest planes first so batches pad little
+    boxes = []
+    for i, slc in enumerate(slices):
+        if slc is not None:
+            if masks.ndim == 2:
+                slc = (slice(0, 1),) + slc
+            starts = [s.start for s in slc]
+            sizes = [s.stop - s.start for s in slc]
+            boxes.append([i + 1] + starts + sizes)
+    boxes = np.array(boxes, dtype=np.int64).reshape(-1, 7)
+    boxes = boxes[np.argsort(boxes[:, 5] * boxes[:, 6], kind="stable")]
+
+    start = 0
+    while start < len(boxes):
+        # grow the batch for as long as the padded stack stays within budget
+        stop, depth, height, width = start, 0, 0, 0
+        while stop < len(boxes):
+            d, h, w = boxes[stop, 4:].tolist()
+            d, h, w = depth + d, max(height, h), max(width, w)
+            if stop > start and d * h * w > _FILL_BATCH_PIXELS:
+                break
+            depth, height, width = d, h, w
+            stop += 1
+        batch = boxes[start:stop]
+        start = stop
+
+        # stack the bounding box planes, padded with a value that never matches a label nor counts as a lower one
+        stack = cp.full(
+            (depth, height, width), np.iinfo(masks_cp.dtype).max, dtype=masks_cp.dtype
+        )
+        offset = 0
+        for _, z, y, x, d, h, w in batch.tolist():
+            stack[offset : offset + d, :h, :w] = planes[z : z + d, y : y + h, x : x + w]
+            offset += d
+        plane_lbls = cp.asarray(np.repeat(batch[:, 0], batch[:, 4]), masks_cp.dtype)
+        plane_z = cp.asarray(np.repeat(batch[:, 1], batch[:, 4]) + _ranges(batch[:, 4]))
+        plane_y = cp.asarray(np.repeat(batch[:, 2], batch[:, 4]))
+        plane_x = cp.asarray(np.repeat(batch[:, 3], batch[:, 4]))
+
+        # label the pixels outside the masks; bounding boxes sit in the corner of their padded plane, so the components
+        # that touch the edge of a plane are exactly the ones that touch the edge of its bounding box
+        lbls = plane_lbls[:, None, None]
+        components, n = label(stack != lbls, structure)
+        enclosed = cp.ones(n + 1, dtype=bool)
+        enclosed[components[:, [0, -1], :]] = False
+        enclosed[components[:, :, [0, -1]]] = False
+
+        # holes are the enclosed pixels that belong to the background or to a lower label
+        holes = enclosed[components] & (stack < lbls)
+        p, y, x = cp.nonzero(holes)
+        y += plane_y[p]
+        x += plane_x[p]
+        index = (plane_z[p] * planes.shape[1] + y) * planes.shape[2] + x
+        cupyx.scatter_max(filled.reshape(-1), index, plane_lbls[p].astype(filled.dtype))
+
+    return filled.astype(masks_cp.dtype, copy=False)
+
+
+def _ranges(lengths):
+    """Concatenation of arange(n) for every n in lengths."""
+    ends = np.cumsum(lengths)
+    return np.arange(ends[-1]) - np.repeat(ends - lengths, lengths)
 
 
 def fill_holes_and_remove_small_masks(masks, min_size=15, n_jobs=-1):
     """Fills holes in masks (2D/3D) and discards masks smaller than min_size.
 
-    This function fills holes in each mask using scipy.ndimage.morphology.binary_fill_holes.
+    This function fills holes in each mask plane by plane on the GPU, by labelling the pixels outside each mask with
+    cupyx.scipy.ndimage.label.
     It also removes masks that are smaller than the specified min_size.
 
     Adapted from CellPose: https://github.com/MouseLand/cellpose
@@ -27,13 +117,13 @@ def fill_holes_and_remove_small_masks(masks, min_size=15, n_jobs=-1):
         Copyright © 2023 Howard Hughes Medical Institute, Authored by Carsen Stringer and Marius Pachitariu.
 
     Parameters:
-    masks (ndarray): Int, 2D or 3D array of labelled masks.
+    masks (ndarray): Int, 2D or 3D array of labelled masks, either in host (NumPy) or device (CuPy) memory.
         0 represents no mask, while positive integers represent mask labels.
         The size can be [Ly x Lx] or [Lz x Ly x Lx].
     min_size (int, optional): Minimum number of pixels per mask.
         Masks smaller than min_size will be removed.
         Set to -1 to turn off this functionality. Default is 15.
-    n_jobs (int): Parallel processing cores to use. Default is -1.
+    n_jobs (int): Unused, since holes are now filled on the GPU. Kept for backwards compatibility. Default is -1.
 
     Returns:
     ndarray: Int, 2D or 3D array of masks with holes filled and small masks removed.
@@ -46,45 +136,37 @@ def fill_holes_and_remove_small_masks(masks, min_size=15, n_jobs=-1):
             "masks_to_outlines takes 2D or 3D array, not %dD array" % masks.ndim
         )
 
-    # Filter small masks
+    masks = cp.asarray(masks)
+
+    # Filter small masks, by relabelling them to 0 through a lookup table
     if min_size > 0:
-        counts = np.bincount(masks.ravel())
-        filter = np.isin(masks, np.where(counts < min_size)[0])
-        masks[filter] = 0
+        counts = cp.bincount(masks.ravel())
+        lut = cp.arange(counts.size, dtype=masks.dtype)
+        lut[counts < min_size] = 0
+        masks = lut[masks]
 
-    slices = find_objects(masks)
+    slices = find_objects(masks.get())
 
-    results = Parallel(n_jobs=n_jobs)(delayed(process_slice)(i, slc, masks) for i, slc in enumerate(slices))
+    # renumber the remaining masks consecutively, while filling their holes
+    present = np.array([slc is not None for slc in slices], dtype=bool)
+    lut = np.zeros(len(slices) + 1, dtype=masks.dtype)
+    lut[1:][present] = np.arange(1, present.sum() + 1)
 
-    j = 0
-    for result in results:
-        if result is not None:
-            slc, msk = result
-            masks[slc][msk] = (j + 1)
-            j += 1
-    return masks
+    return cp.asarray(lut)[_fill_holes(masks, slices)].get()
 
 
 def filter_nuclei_cells(volumetric_masks, nuclei_masks):
 
-    # Convert nuclei masks to a boolean array to make the later comparison easier
-    nuclei_masks = cp.asarray(nuclei_masks.astype(bool))
+    # Nuclei masks are uploaded as they are; _flag_nuclear only tests them against 0
+    nuclei_masks = cp.asarray(nuclei_masks)
     volumetric_masks = cp.asarray(volumetric_masks)
 
-    nuclear_cells = cp.zeros_like(volumetric_masks)
-
-    unique_labels = cp.unique(volumetric_masks)
-
-    # Initialize new label ID
-    new_label_id = 1
-    for label_id in unique_labels[unique_labels != 0]:
-
-        # Create a boolean mask for each label ID
-        mask = (volumetric_masks == label_id)
+    # Flag the labels that have any overlap with the known nuclei
+    is_nuclear = cp.zeros(int(volumetric_masks.max()) + 1, dtype=bool)
+    _flag_nuclear(volumetric_masks, nuclei_masks, is_nuclear)
+    is_nuclear[0] = False
 
-        # If there is any overlap between the mask and the known nuclei
-        if cp.any(mask & nuclei_masks):
-            nuclear_cells[mask] = new_label_id  # Assign new label ID
-            new_label_id += 1
+    # Assign new label IDs, in order of the original label IDs, and relabel with a single gather
+    lut = (cp.cumsum(is_nuclear) * is_nuclear).astype(volumetric_masks.dtype)
 
-    return nuclear_cells.get()
+    return lut[volumetric_masks].get()
@@ -3,8 +3,107 @@ import numpy as np
 import torch
 from torch.utils.data import DataLoader
 from cellstitch_cuda.seg_batch import ImageDataset
+from concurrent.futures import ThreadPoolExecutor
 import sys
-from cupyx.scipy.ndimage import zoom
+
+
+# Upper bound on the number of pixels histogram-matched at once in _correct
+_MATCH_BATCH_PIXELS = 2**23
+
+# Device memory used per pixel of a histogram-matching batch: _match_cdf keeps about ten 8 byte temporaries alive
+_MATCH_BYTES_PER_PIXEL = 80
+
+# Largest slice (in elements) handed to InstanSeg on the GPU: it normalises CUDA tensors with torch.quantile, which
+# refuses larger inputs
+_PREFETCH_MAX_ELEMENTS = 2**24
+
+# Linear interpolation along one axis of a C-contiguous array, with rounding for integer outputs
+_resample_axis = cp.ElementwiseKernel(
+    "raw T x, raw int64 lo, raw int64 hi, raw float64 w, int64 n_in, int64 n_out, int64 inner",
+    "U out",
+    """
+    long long k = i % inner;
+    long long j = (i / inner) % n_out;
+    long long base = (i / (inner * n_out)) * n_in * inner + k;
+    double v = (1.0 - w[j]) * (double)x[base + lo[j] * inner] + w[j] * (double)x[base + hi[j] * inner];
+    out = _round_cast<U>(v);
+    """,
+    "resample_axis",
+    preamble="""
+    template <typename U> __device__ U _round_cast(double v) { return (U)rint(v); }
+    template <> __device__ float _round_cast<float>(double v) { return (float)v; }
+    template <> __device__ double _round_cast<double>(double v) { return v; }
+    """,
+)
+
+
+def _zoom_axis(arr, axis, factor, order, dtype):
+    """Resample arr along a single axis, in one pass over the output."""
+    arr = cp.ascontiguousarray(arr)
+    n_in = arr.shape[axis]
+    n_out = int(round(n_in * factor))
+    inner = int(np.prod(arr.shape[axis + 1 :]))
+
+    # Same coordinate mapping as cupyx.scipy.ndimage.zoom
+    coords = cp.arange(n_out) * ((n_in - 1) / (n_out - 1) if n_out > 1 else 0.0)
+    if order == 0:
+        lo = cp.floor(coords + 0.5).astype(cp.int64)
+        weights = cp.zeros(n_out)
+    else:
+        lo = cp.floor(coords).astype(cp.int64)
+        weights = coords - lo
+    hi = cp.minimum(lo + 1, n_in - 1)
+
+    out = cp.empty(arr.shape[:axis] + (n_out,) + arr.shape[axis + 1 :], dtype=dtype)
+    _resample_axis(arr, lo, hi, weights, n_in, n_out, inner, out)
+
+    return out
+
+
+def _zoom(arr, zoom_factors, order):
+    """Zoom arr with nearest neighbor (order 0) or linear (order 1) interpolation.
+
+    Uses the same coordinate mapping as cupyx.scipy.ndimage.zoom, but resamples one axis at a time and skips the axes
+    whose size does not change, instead of running the general N-D spline kernel over all axes. Order 0 gives the same
+    result; order 1 is equal up to rounding, as the separable passes round differently from joint interpolation.
+    """
+    axes = [
+        (axis, factor)
+        for axis, factor in enumerate(zoom_factors)
+        if int(round(arr.shape[axis] * factor)) != arr.shape[axis]
+    ]
+
+    dtype = arr.dtype
+    for n, (axis, factor) in enumerate(axes):
+        # Keep intermediate results of a linear zoom unrounded, in double precision
+        out_dtype = dtype if order == 0 or n == len(axes) - 1 else cp.float64
+        arr = _zoom_axis(arr, axis, factor, order, out_dtype)
+
+    return arr
+
+
+def downcast_labels(masks):
+    """Cast label masks to uint16 if all labels fit, or to uint32 otherwise."""
+    if int(masks.max()) <= np.iinfo(np.uint16).max:
+        return masks.astype(np.uint16, copy=False)
+    return masks.astype(np.uint32, copy=False)
+
+
+def _match_batch(pixel_size, fraction=0.25):
+    """Number of slices of pixel_size pixels to histogram-match at once, using at most fraction of the free VRAM."""
+    budget = min(_MATCH_BATCH_PIXELS, int(fraction * cp.cuda.Device().mem_info[0]) // _MATCH_BYTES_PER_PIXEL)
+    return max(1, budget // pixel_size)
+
+
+def _trim_memory_pool(fraction=0.25):
+    """Free the blocks cached by the CuPy memory pool, but only once they take up more than fraction of the GPU.
+
+    Freeing synchronizes the device, and the next allocations have to go through cudaMalloc again, so loops trim the
+    pool rather than emptying it on every iteration.
+    """
+    pool = cp._default_memory_pool
+    if pool.total_bytes() - pool.used_bytes() > fraction * cp.cuda.Device().mem_info[1]:
+        pool.free_all_blocks()
 
 
 def downscale_mask(masks, pixel=None, z_res=None):
@@ -17,9 +116,9 @@ def downscale_mask(masks, pixel=None, z_res=None):
 
     anisotropy = z_res / pixel
     zoom_factors = (1/(pixel/0.5), 1 / (anisotropy*(pixel/0.5)), 1)
-    order = 0  # 0 nearest neighbor, 1 bilinear, 2 quadratic, 3 bicubic
+    order = 0  # 0 nearest neighbor, 1 linear
 
-    masks = zoom(masks, zoom_factors, order=order).get()
+    masks = _zoom(masks, zoom_factors, order)
     cp._default_memory_pool.free_all_blocks()
 
     return masks
@@ -33,12 +132,12 @@ def upscale_img(images, pixel=None, z_res=None):
 
     anisotropy = z_res / pixel
     zoom_factors = (pixel/0.5, anisotropy*(pixel/0.5), 1)  # Pre-zoom for InstanSeg (expected pixel size = 0.5)
-    order = 1  # 0 nearest neighbor, 1 bilinear, 2 quadratic, 3 bicubic
+    order = 1  # 0 nearest neighbor, 1 linear
 
     zoomed = []
     for ch in images:  # CiZk
-        ch = zoom(cp.asarray(ch), zoom_factors, order=order).get()
-        cp._default_memory_pool.free_all_blocks()
+        ch = _zoom(cp.asarray(ch), zoom_factors, order).get()
+        _trim_memory_pool()
         zoomed.append(ch)
 
     cp._default_memory_pool.free_all_blocks()
@@ -46,6 +145,27 @@ def upscale_img(images, pixel=None, z_res=None):
     return np.stack(zoomed)
 
 
+def upscale_img_async(images, pixel=None, z_res=None):
+    """Run upscale_img in a background thread, on a non-blocking CUDA stream of its own.
+
+    Returns a concurrent.futures.Future holding the upscaled images, so the upscaling can overlap with GPU work on
+    other streams, such as segmentation. Work already queued on the current stream (e.g. producing images on the GPU)
+    is waited for.
+    """
+    queued = cp.cuda.get_current_stream().record()
+
+    def run():
+        with cp.cuda.Stream(non_blocking=True) as stream:
+            stream.wait_event(queued)
+            return upscale_img(images, pixel, z_res)
+
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(run)
+    executor.shutdown(wait=False)
+
+    return future
+
+
 def histogram_correct(images, match: str = "first"):
     """Correct bleaching over a given axis
 
@@ -74,9 +194,11 @@ def histogram_correct(images, match: str = "first"):
     corrected = []
     for ch in images:
         ch = _correct(cp.asarray(ch), match).get()
-        cp._default_memory_pool.free_all_blocks()
+        _trim_memory_pool()
         corrected.append(ch)
 
+    cp._default_memory_pool.free_all_blocks()
+
     images = np.stack(corrected, axis=1, dtype=dtype)  # ZCYX
 
     return images
@@ -90,15 +212,27 @@ def _correct(channel, match):
 
     # flatten the last dimensions and calculate normalized cdf
     channel = channel.reshape(k, -1)
+
+    if channel.dtype in (cp.uint8, cp.uint16):
+        return _correct_lut(channel, match).reshape(k, m, n)
+
+    if match == "first":
+        # Every slice is matched to the first one, so the slices can be matched in batches
+        val, cnt = cp.unique(channel[0, ...], return_counts=True)
+        cdf = cp.cumsum(cnt) / pixel_size
+
+        batch = _match_batch(pixel_size)
+        for i in range(1, k, batch):
+            channel[i : i + batch] = _match_cdf(channel[i : i + batch], cdf, val)
+
+        return channel.reshape(k, m, n)
+
     values, cdfs = [], []
 
     for i in range(k):
 
         if i > 0:
-            if match == "first":
-                match_ix = 0
-            else:
-                match_ix = i - 1
+            match_ix = i - 1
 
             val, ix, cnt = cp.unique(
                 channel[i, ...].flatten(), return_inverse=True, return_counts=True
@@ -108,17 +242,72 @@ def _correct(channel, match):
             interpolated = cp.interp(cdf, cdfs[match_ix], values[match_ix])
             channel[i, ...] = interpolated[ix]
 
-        if i == 0 or match == "neighbor":
-            val, cnt = cp.unique(channel[i, ...].flatten(), return_counts=True)
-            cdf = cp.cumsum(cnt) / pixel_size
-            values.append(val)
-            cdfs.append(cdf)
+        val, cnt = cp.unique(channel[i, ...].flatten(), return_counts=True)
+        cdf = cp.cumsum(cnt) / pixel_size
+        values.append(val)
+        cdfs.append(cdf)
 
     channel = channel.reshape(k, m, n)
 
     return channel
 
 
+def _correct_lut(channel, match):
+    """Histogram-match the flattened slices of a uint8 or uint16 channel through lookup tables.
+
+    With at most 65536 possible values, the histograms are built with a bincount over the full value range, and every
+    slice is mapped in one gather through its lookup table.
+    """
+    k, pixel_size = channel.shape
+    bins = 2 ** (8 * channel.dtype.itemsize)
+
+    batch = 1
+    if match == "first":
+        batch = _match_batch(max(pixel_size, bins))
+
+    hist_ref = cp.bincount(channel[0], minlength=bins)
+    for i in range(1, k, batch):
+        slices = channel[i : i + batch]
+        b = slices.shape[0]
+
+        values_ref = cp.flatnonzero(hist_ref)
+        cdf_ref = cp.cumsum(hist_ref)[values_ref] / pixel_size
+
+        offsets = cp.arange(b)[:, None] * bins
+        hist = cp.bincount((slices + offsets).ravel(), minlength=b * bins)
+        cdf = cp.cumsum(hist.reshape(b, bins), axis=1) / pixel_size
+
+        lut = cp.interp(cdf.ravel(), cdf_ref, values_ref)
+        channel[i : i + batch] = lut[slices + offsets]
+
+        if match == "neighbor":
+            hist_ref = cp.bincount(channel[i], minlength=bins)
+
+    return channel
+
+
+def _match_cdf(slices, cdf_ref, values_ref):
+    """Match the histograms of a batch of flattened slices to a reference cdf."""
+    b, pixel_size = slices.shape
+
+    order = cp.argsort(slices, axis=1)
+    sorted_values = cp.take_along_axis(slices, order, axis=1)
+
+    # The cdf of a value is the position of the end of its run of equal values in the sorted slice
+    run_start = cp.ones(sorted_values.shape, dtype=bool)
+    run_start[:, 1:] = sorted_values[:, 1:] != sorted_values[:, :-1]
+    run_id = cp.cumsum(run_start.ravel()) - 1
+    run_end = cp.cumsum(cp.bincount(run_id))
+    offsets = cp.arange(b)[:, None] * pixel_size
+    cdf = (run_end[run_id].reshape(b, -1) - offsets) / pixel_size
+
+    interpolated = cp.interp(cdf.ravel(), cdf_ref, values_ref)
+    matched = cp.empty_like(interpolated)
+    matched[(order + offsets).ravel()] = interpolated
+
+    return matched.reshape(b, -1)
+
+
 def segment_single_slice_medium(
     d, model, tiles, batch_size,
 ):
@@ -147,10 +336,69 @@ def segment_single_slice_small(d, model):
     return res[0]
 
 
+def _prefetch_slices(d, device):
+    """Yield the slices d[:, :, :, k] as tensors on device.
+
+    Slice k + 1 is uploaded on a separate CUDA stream while slice k is being segmented. Every slice has the same shape,
+    so two device buffers (and, for NumPy input, two pinned host buffers) are allocated once and alternated between,
+    instead of allocating and pinning fresh memory per slice. A yielded tensor is therefore only valid until the next
+    one is requested. CuPy slices are cast into the device buffers through DLPack, so they are never copied to the host.
+    """
+    stream = torch.cuda.Stream(device=device)
+    device_buffers = [
+        torch.empty(d.shape[:3], dtype=torch.float32, device=device) for _ in range(2)
+    ]
+    host_buffers = None
+    if not isinstance(d, cp.ndarray):
+        host_buffers = [
+            torch.empty(d.shape[:3], dtype=torch.float32, pin_memory=True)
+            for _ in range(2)
+        ]
+    uploaded = [None, None]
+
+    def upload(k):
+        i = k % 2
+        # wait until the buffers are no longer read by the previous copy into them, or by its segmentation
+        if uploaded[i] is not None:
+            uploaded[i].synchronize()
+        stream.wait_stream(torch.cuda.current_stream(device))
+        with torch.cuda.stream(stream):
+            if host_buffers is None:
+                # cast to float32 in CuPy, straight into the buffer, as Torch cannot import every dtype through DLPack
+                with cp.cuda.ExternalStream(stream.cuda_stream):
+                    cp.from_dlpack(device_buffers[i])[...] = d[:, :, :, k]
+            else:
+                np.copyto(host_buffers[i].numpy(), d[:, :, :, k])
+                device_buffers[i].copy_(host_buffers[i], non_blocking=True)
+            uploaded[i] = torch.cuda.Event()
+            uploaded[i].record(stream)
+        return device_buffers[i], uploaded[i]
+
+    upcoming = upload(0)
+    for k in range(d.shape[-1]):
+        tensor, event = upcoming
+        if k + 1 < d.shape[-1]:
+            upcoming = upload(k + 1)
+        torch.cuda.current_stream(device).wait_event(event)
+        yield tensor
+
+
+def _iter_slices(d, model):
+    """Iterate over the slices d[:, :, :, k], prefetched to the GPU when InstanSeg runs on CUDA.
+
+    Slices of more than _PREFETCH_MAX_ELEMENTS elements, such as the ones segmented in tiles, are handed to InstanSeg
+    as host arrays instead, so it normalises them on the CPU.
+    """
+    device = torch.device(model.inference_device)
+    if device.type == "cuda" and np.prod(d.shape[:3]) <= _PREFETCH_MAX_ELEMENTS:
+        return _prefetch_slices(d, device)
+    return (cp.asnumpy(d[:, :, :, k]) for k in range(d.shape[-1]))
+
+
 def segment_batch_slice_small(d, model):
     result = []
     for batch in d:
-        batch = batch.to(model.inference_device)
+        batch = batch.to(model.inference_device, non_blocking=True)
         target_segmentation = torch.tensor([1, 1])
         with torch.amp.autocast('cuda'):
             instanseg_kwargs = {"cleanup_fragments": True}
@@ -173,8 +421,6 @@ def segmentation(d, model, m: str = "nuclei_cells", xy: bool = False):
     if xy and m == "nuclei_cells":
         nuclei_cells = True
 
-    nslices = d.shape[-1]
-
     vram = torch.cuda.mem_get_info()[0] / 1024  # In KB
     vram_est = 0.1765 * np.prod(d.shape[0:3])  # Magic number literally obtained by plotting in Excel
 
@@ -199,24 +445,30 @@ def segmentation(d, model, m: str = "nuclei_cells", xy: bool = False):
         if batch > 2:
             d = d.transpose(3, 0, 1, 2)  # CYXZ --> ZCYX || Cijk --> kCij
             dataset = ImageDataset(d)
-            dataloader = DataLoader(dataset, batch_size=batch-1, shuffle=False, drop_last=False)
+            dataloader = DataLoader(
+                dataset,
+                batch_size=batch - 1,
+                shuffle=False,
+                drop_last=False,
+                pin_memory=isinstance(d, np.ndarray) and torch.cuda.is_available(),
+            )
             empty_res, nuclei = segment_batch_slice_small(dataloader, model)
         else:  # If only 1 or 2 z planes fit into VRAM, go z by z (or whichever iterating image axis is last)
-            empty_res = np.zeros_like(d[0])
+            empty_res = np.zeros(d.shape[1:], dtype=np.uint32)
             nuclei = empty_res.copy()
-            for xyz in range(nslices):
-                res_slice = segment_single_slice_small(d[:, :, :, xyz], model)
+            for xyz, d_slice in enumerate(_iter_slices(d, model)):
+                res_slice = segment_single_slice_small(d_slice, model)
                 empty_res[:, :, xyz] = res_slice[mode]
                 if nuclei_cells:
                     nuclei[:, :, xyz] = res_slice[0]
     else:  # For larger images
-        empty_res = np.zeros_like(d[0])
+        empty_res = np.zeros(d.shape[1:], dtype=np.uint32)
         nuclei = empty_res.copy()
-        for xyz in range(nslices):
-            res_slice = segment_single_slice_medium(d[:, :, :, xyz], model, tiles, batch)
+        for xyz, d_slice in enumerate(_iter_slices(d, model)):
+            res_slice = segment_single_slice_medium(d_slice, model, tiles, batch)
             empty_res[:, :, xyz] = res_slice[mode]
             if nuclei_cells:
                 nuclei[:, :, xyz] = res_slice[0]
     if nuclei_cells:
-        return empty_res, nuclei
-    return empty_res
+        return downcast_labels(empty_res), downcast_labels(nuclei)
+    return downcast_labels(empty_res)
@@ -1,6 +1,7 @@
 from torch.utils.data import Dataset
 import torch
 import numpy as np
+import cupy as cp
 
 
 class ImageDataset(Dataset):
@@ -15,6 +16,14 @@ class ImageDataset(Dataset):
         percentile = 0.1
 
         image = self.image_list[idx]
+        if isinstance(image, cp.ndarray):
+            # Normalise with CuPy, since torch.quantile refuses inputs of more than 2**24 elements
+            image = cp.atleast_3d(image.astype(cp.float32).squeeze())
+            for c in range(image.shape[0]):
+                (p_min, p_max) = cp.percentile(image, [percentile, 100 - percentile])
+                image[c] = (image[c] - p_min) / cp.maximum(epsilon, p_max - p_min)
+            return torch.from_dlpack(image)  # Stays on the GPU
+
         if isinstance(image, np.ndarray):
             if image.dtype == np.uint16:
                 image = image.astype(np.int32)